@@ -0,0 +1,64 @@
+`default_nettype none
+`timescale 1ns / 1ps
+
+/* Testbench-only PWM meter. Toggling req arms a measurement of sig in clk
+   cycles: rising -> falling edge is latched into high_cnt and rising ->
+   next rising edge into period_cnt, then ready pulses for one clk cycle.
+   Toggles while measuring are ignored; reset returns to idle and re-syncs req.
+*/
+module pwm_meter (
+    input  wire        clk,
+    input  wire        rst_n,       // reset_n - low to reset
+    input  wire        req,         // toggle to start a measurement
+    input  wire        sig,
+    output reg  [31:0] high_cnt,
+    output reg  [31:0] period_cnt,
+    output reg         ready
+);
+
+  localparam IDLE = 3'd0, ARMED = 3'd1, HIGH = 3'd2, LOW = 3'd3, DONE = 3'd4;
+
+  reg [2:0]  state;
+  reg        req_q;
+  reg        sig_q;
+  reg [31:0] count;
+
+  wire rise = sig && !sig_q;
+  wire fall = !sig && sig_q;
+
+  always @(posedge clk or negedge rst_n) begin
+    if (!rst_n) begin
+      state <= IDLE;
+      req_q <= req;
+      sig_q <= sig;
+      ready <= 1'b0;
+    end else begin
+      req_q <= req;
+      sig_q <= sig;
+      ready <= 1'b0;
+      count <= count + 1;
+      case (state)
+        IDLE:  if (req != req_q) state <= ARMED;
+        ARMED: if (rise) begin
+          count <= 1;
+          state <= HIGH;
+        end
+        HIGH:  if (fall) begin
+          high_cnt <= count;
+          state    <= LOW;
+        end
+        LOW:   if (rise) begin
+          period_cnt <= count;
+          state      <= DONE;
+        end
+        // Counts are stable by now, so they can be read on the ready edge
+        DONE:  begin
+          ready <= 1'b1;
+          state <= IDLE;
+        end
+        default: state <= IDLE;
+      endcase
+    end
+  end
+
+endmodule
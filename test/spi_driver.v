@@ -0,0 +1,89 @@
+`default_nettype none
+`timescale 1ns / 1ps
+
+/* Testbench-only SPI controller. Toggling req shifts frame out MSB first
+   (mode 0) on ncs/sclk/copi without any per-edge help from cocotb, then
+   pulses done for one clk cycle once the peripheral had time to commit.
+   Toggles while busy are ignored; reset returns to idle and re-syncs req.
+*/
+module spi_driver #(
+    parameter HALF_SCLK_CYCLES = 50,   // 100 ns clk -> 10 us SCLK period
+    parameter TAIL_CYCLES      = 8     // nCS sync + commit + PWM output register
+) (
+    input  wire        clk,
+    input  wire        rst_n,    // reset_n - low to reset
+    input  wire        req,      // toggle to start a transaction
+    input  wire [15:0] frame,    // {rw, addr[6:0], data[7:0]}
+    output wire        busy,
+    output reg         done,
+    output reg         ncs,
+    output reg         sclk,
+    output reg         copi
+);
+
+  localparam IDLE = 2'd0, LOW = 2'd1, HIGH = 2'd2, TAIL = 2'd3;
+
+  reg [1:0]  state;
+  reg        req_q;
+  reg [15:0] shift;
+  reg [4:0]  bits_left;
+  reg [15:0] count;
+
+  assign busy = (state != IDLE);
+
+  always @(posedge clk or negedge rst_n) begin
+    if (!rst_n) begin
+      state <= IDLE;
+      req_q <= req;
+      done  <= 1'b0;
+      ncs   <= 1'b1;
+      sclk  <= 1'b0;
+      copi  <= 1'b0;
+    end else begin
+      done <= 1'b0;
+      case (state)
+        IDLE: if (req != req_q) begin
+          // Pull nCS low and present the first bit with SCLK low
+          req_q     <= req;
+          shift     <= frame;
+          bits_left <= 5'd16;
+          ncs       <= 1'b0;
+          copi      <= frame[15];
+          count     <= HALF_SCLK_CYCLES - 1;
+          state     <= LOW;
+        end
+        LOW: if (count != 0) begin
+          count <= count - 1;
+        end else begin
+          sclk  <= 1'b1;
+          count <= HALF_SCLK_CYCLES - 1;
+          state <= HIGH;
+        end
+        HIGH: if (count != 0) begin
+          count <= count - 1;
+        end else if (bits_left != 5'd1) begin
+          sclk      <= 1'b0;
+          copi      <= shift[14];
+          shift     <= {shift[14:0], 1'b0};
+          bits_left <= bits_left - 5'd1;
+          count     <= HALF_SCLK_CYCLES - 1;
+          state     <= LOW;
+        end else begin
+          // Last bit sent: return nCS high and let the peripheral commit
+          sclk  <= 1'b0;
+          copi  <= 1'b0;
+          ncs   <= 1'b1;
+          count <= TAIL_CYCLES - 1;
+          state <= TAIL;
+        end
+        TAIL: if (count != 0) begin
+          count <= count - 1;
+        end else begin
+          done  <= 1'b1;
+          state <= IDLE;
+        end
+      endcase
+    end
+  end
+
+endmodule
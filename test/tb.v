@@ -6,10 +6,13 @@
 */
 module tb ();
 
-  // Dump the signals to a VCD file. You can view it with gtkwave or surfer.
+  // Dump the signals to a VCD file when run with +vcd (make VCD=1).
+  // You can view it with gtkwave or surfer.
   initial begin
-    $dumpfile("tb.vcd");
-    $dumpvars(0, tb);
+    if ($test$plusargs("vcd")) begin
+      $dumpfile("tb.vcd");
+      $dumpvars(0, tb);
+    end
     #1;
   end
 
@@ -22,6 +25,55 @@ module tb ();
   wire [7:0] uo_out;
   wire [7:0] uio_out;
   wire [7:0] uio_oe;
+
+  // 10 MHz clock generated here so idle cycles never enter Python.
+  // Keep in sync with CLK_PERIOD_NS in test.py.
+  initial clk = 1'b0;
+  always #50 clk = ~clk;
+
+  // HDL-side SPI controller used by send_spi_transaction() in test.py. While
+  // it is busy it owns nCS/COPI/SCLK, otherwise ui_in is passed through.
+  reg  [15:0] spi_frame;
+  reg         spi_req;
+  wire        spi_busy;
+  wire        spi_done;
+  wire        spi_ncs, spi_sclk, spi_copi;
+
+  initial spi_req = 1'b0;
+
+  spi_driver spi_driver_inst (
+      .clk  (clk),
+      .rst_n(rst_n),
+      .req  (spi_req),
+      .frame(spi_frame),
+      .busy (spi_busy),
+      .done (spi_done),
+      .ncs  (spi_ncs),
+      .sclk (spi_sclk),
+      .copi (spi_copi)
+  );
+
+  wire [7:0] dut_ui_in = spi_busy ? {ui_in[7:3], spi_ncs, spi_copi, spi_sclk} : ui_in;
+
+  // HDL-side PWM meter used by measure_pwm_high_and_period_ns() in test.py.
+  // Counts the uo_out[0] high time and period in clk cycles.
+  reg         meter_req;
+  wire [31:0] meter_high;
+  wire [31:0] meter_period;
+  wire        meter_ready;
+
+  initial meter_req = 1'b0;
+
+  pwm_meter pwm_meter_inst (
+      .clk       (clk),
+      .rst_n     (rst_n),
+      .req       (meter_req),
+      .sig       (uo_out[0]),
+      .high_cnt  (meter_high),
+      .period_cnt(meter_period),
+      .ready     (meter_ready)
+  );
+
 `ifdef GL_TEST
   wire VPWR = 1'b1;
   wire VGND = 1'b0;
@@ -36,7 +88,7 @@ module tb ();
       .VGND(VGND),
 `endif
 
-      .ui_in  (ui_in),    // Dedicated inputs
+      .ui_in  (dut_ui_in),  // Dedicated inputs
       .uo_out (uo_out),   // Dedicated outputs
       .uio_in (uio_in),   // IOs: Input path
       .uio_out(uio_out),  // IOs: Output path